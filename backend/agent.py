@@ -8,17 +8,24 @@ builds and runs Docker containers, and streams logs/metrics back to the Console.
 
 import asyncio
 import websockets
-import json
+import orjson
 import logging
 import docker
 import os
 import tempfile
 import shutil
-from datetime import datetime
+import threading
+import time
+from contextlib import aclosing
+from datetime import datetime, timezone
 import psutil
-import subprocess
 from pathlib import Path
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -36,11 +43,25 @@ MAX_RETRIES = 3
 INITIAL_BACKOFF = 2  # seconds
 MAX_BACKOFF = 60  # seconds
 
+GIT_CLONE_TIMEOUT = 300  # seconds
+
+# Deploys queue behind this many workers so bursts don't thrash the Docker daemon
+DEPLOY_WORKERS = 2
+
+METRICS_INTERVAL = 10  # seconds between metrics samples per container
+
+# Outgoing messages queued within this many bytes share one WebSocket frame
+SEND_BATCH_BYTES = 8 * 1024
+OUTBOX_SIZE = 1024  # queued messages before senders wait on the Console
+
+STREAM_BUFFER_SIZE = 1024  # docker stream items held per reader thread, oldest dropped
+
 # Docker client
 docker_client = docker.from_env()
 
 # Track running containers
 running_containers = {}
+container_started_at = {}  # app_id -> time.monotonic() at start, for uptime without an inspect call
 
 # Graceful shutdown flag
 shutdown_flag = False
@@ -48,8 +69,12 @@ shutdown_flag = False
 class Agent:
     def __init__(self):
         self.websocket = None
+        self.outbox = None  # created per connection in connect()
+        self.deploy_queue = asyncio.Queue()
+        self.deploy_workers = []
         self.running = True
-        self.current_build = None  # Track current build for graceful shutdown
+        self.current_builds = set()  # In-flight deployment ids, for graceful shutdown
+        self.app_locks = {}  # app_id -> asyncio.Lock; builds of one app share WORK_DIR / app_id
     
     async def connect_with_retry(self):
         """Connect to Console with exponential backoff retry"""
@@ -78,32 +103,37 @@ class Agent:
         logger.info(f"Connecting to Console at {CONSOLE_WS_URL}")
         
         async with websockets.connect(CONSOLE_WS_URL) as websocket:
+            # Fresh outbox per connection so frames queued for a dead socket are never replayed
+            self.outbox = asyncio.Queue(maxsize=OUTBOX_SIZE)
             self.websocket = websocket
             logger.info("Connected to Console")
+            sender = asyncio.create_task(self.sender_loop())
             
-            # Send registration
-            await self.send_message({
-                "type": "register",
-                "agent_name": AGENT_NAME
-            })
-            
-            # Start metrics loop
-            asyncio.create_task(self.metrics_loop())
-            
-            # Listen for commands
-            await self.listen_for_commands()
+            try:
+                # Send registration
+                await self.send_message({
+                    "type": "register",
+                    "agent_name": AGENT_NAME
+                })
+                
+                # Listen for commands
+                await self.listen_for_commands()
+            finally:
+                sender.cancel()
+                self.websocket = None
+                await self.discard_outbox()
     
     async def listen_for_commands(self):
         """Listen for deployment commands from Console"""
         try:
             async for message in self.websocket:
-                data = json.loads(message)
+                data = orjson.loads(message)
                 msg_type = data.get('type')
                 
                 logger.info(f"Received command: {msg_type}")
                 
                 if msg_type == 'deploy':
-                    asyncio.create_task(self.handle_deploy(data))
+                    self.deploy_queue.put_nowait(data)
                 elif msg_type == 'stop':
                     asyncio.create_task(self.handle_stop(data))
                 elif msg_type == 'restart':
@@ -117,10 +147,35 @@ class Agent:
             logger.error(f"Error in listen loop: {e}")
     
     async def send_message(self, data: dict):
-        """Send message to Console"""
+        """Queue message for Console; sender_loop writes it out. Waits while the outbox is full, drops while disconnected"""
         if self.websocket:
+            await self.outbox.put(orjson.dumps(data, option=orjson.OPT_UTC_Z | orjson.OPT_NAIVE_UTC))
+    
+    async def discard_outbox(self):
+        """Drop undelivered frames, releasing senders still waiting on a full outbox"""
+        while not self.outbox.empty():
+            was_full = self.outbox.full()
+            self.outbox.get_nowait()
+            if was_full:
+                await asyncio.sleep(0)  # A sender may be waiting on this slot; let it finish its put
+    
+    async def sender_loop(self):
+        """Drain the outbox, coalescing queued messages into batch frames"""
+        while True:
+            parts = [await self.outbox.get()]
+            size = len(parts[0])
+            while size < SEND_BATCH_BYTES and not self.outbox.empty():
+                part = self.outbox.get_nowait()
+                parts.append(part)
+                size += len(part)
+            
+            if len(parts) == 1:
+                payload = parts[0]
+            else:
+                payload = b'{"type":"batch","msgs":[' + b','.join(parts) + b']}'
+            
             try:
-                await self.websocket.send(json.dumps(data))
+                await self.websocket.send(payload)
             except Exception as e:
                 logger.error(f"Failed to send message: {e}")
     
@@ -131,7 +186,7 @@ class Agent:
             "app_id": app_id,
             "deployment_id": deployment_id,
             "log": log_line,
-            "timestamp": datetime.utcnow().isoformat()
+            "timestamp": datetime.now(timezone.utc)
         })
     
     async def send_status_update(self, app_id: str, deployment_id: str, status: str):
@@ -143,6 +198,24 @@ class Agent:
             "status": status
         })
     
+    def start_deploy_workers(self):
+        """Launch the fixed pool of deploy workers"""
+        self.deploy_workers = [
+            asyncio.create_task(self.deploy_worker()) for _ in range(DEPLOY_WORKERS)
+        ]
+    
+    async def deploy_worker(self):
+        """Run queued deployments one at a time; deploys of the same app never overlap"""
+        while True:
+            data = await self.deploy_queue.get()
+            try:
+                async with self.app_locks.setdefault(data.get('app_id'), asyncio.Lock()):
+                    await self.handle_deploy(data)
+            except Exception as e:
+                logger.error(f"Deploy worker error: {e}")
+            finally:
+                self.deploy_queue.task_done()
+    
     async def handle_deploy(self, data: dict):
         """Handle deployment command"""
         app_id = data.get('app_id')
@@ -155,7 +228,7 @@ class Agent:
             await self.send_log(app_id, deployment_id, "Agent shutting down - deployment cancelled")
             return
         
-        self.current_build = deployment_id
+        self.current_builds.add(deployment_id)
         logger.info(f"Deploying app {app_id} from {repo_url}")
         
         try:
@@ -170,15 +243,7 @@ class Agent:
             
             # Clone repository
             await self.send_log(app_id, deployment_id, f"Cloning repository: {repo_url}")
-            clone_result = subprocess.run(
-                ['git', 'clone', repo_url, str(app_dir)],
-                capture_output=True,
-                text=True,
-                timeout=300
-            )
-            
-            if clone_result.returncode != 0:
-                raise Exception(f"Git clone failed: {clone_result.stderr}")
+            await self.git_clone(app_id, deployment_id, repo_url, app_dir)
             
             await self.send_log(app_id, deployment_id, "Repository cloned successfully")
             
@@ -191,7 +256,8 @@ class Agent:
             image_tag = f"dsi-{app_name}:{deployment_id[:8]}"
             await self.send_log(app_id, deployment_id, f"Building Docker image: {image_tag}")
             
-            image, build_logs = docker_client.images.build(
+            image, build_logs = await asyncio.to_thread(
+                docker_client.images.build,
                 path=str(app_dir),
                 tag=image_tag,
                 rm=True
@@ -209,15 +275,16 @@ class Agent:
             if app_id in running_containers:
                 try:
                     old_container = running_containers[app_id]
-                    old_container.stop(timeout=10)
-                    old_container.remove()
+                    await asyncio.to_thread(old_container.stop, timeout=10)
+                    await asyncio.to_thread(old_container.remove)
                 except Exception as e:
                     logger.warning(f"Failed to stop old container: {e}")
             
             # Run container
             await self.send_log(app_id, deployment_id, "Starting container...")
             
-            container = docker_client.containers.run(
+            container = await asyncio.to_thread(
+                docker_client.containers.run,
                 image_tag,
                 detach=True,
                 name=f"dsi-{app_name}-{app_id[:8]}",
@@ -227,9 +294,10 @@ class Agent:
             )
             
             running_containers[app_id] = container
+            container_started_at[app_id] = time.monotonic()
             
             # Get assigned port
-            container.reload()
+            await asyncio.to_thread(container.reload)
             port_bindings = container.attrs['NetworkSettings']['Ports']
             host_port = None
             if '8080/tcp' in port_bindings and port_bindings['8080/tcp']:
@@ -252,8 +320,9 @@ class Agent:
             
             await self.send_status_update(app_id, deployment_id, "running")
             
-            # Start log streaming for this container
+            # Start log and metrics streaming for this container
             asyncio.create_task(self.stream_container_logs(app_id, deployment_id, container))
+            asyncio.create_task(self.stream_container_stats(app_id, container))
         
         except Exception as e:
             error_msg = f"Deployment failed: {str(e)}"
@@ -261,18 +330,79 @@ class Agent:
             await self.send_log(app_id, deployment_id, error_msg)
             await self.send_status_update(app_id, deployment_id, "failed")
         finally:
-            self.current_build = None
+            self.current_builds.discard(deployment_id)
+    
+    async def git_clone(self, app_id: str, deployment_id: str, repo_url: str, app_dir: Path):
+        """Shallow-clone a repository without blocking the event loop, relaying git output as logs"""
+        proc = await asyncio.create_subprocess_exec(
+            'git', 'clone', '--depth=1', '--filter=blob:none', '--single-branch',
+            '--', repo_url, str(app_dir),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+        output = []
+        
+        async def relay_output():
+            async for line in proc.stdout:
+                log_line = line.decode('utf-8', errors='replace').strip()
+                if log_line:
+                    output.append(log_line)
+                    await self.send_log(app_id, deployment_id, log_line)
+            await proc.wait()
+        
+        try:
+            await asyncio.wait_for(relay_output(), timeout=GIT_CLONE_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise Exception(f"Git clone timed out after {GIT_CLONE_TIMEOUT}s")
+        
+        if proc.returncode != 0:
+            details = '\n'.join(output)
+            raise Exception(f"Git clone failed: {details}")
     
     async def stream_container_logs(self, app_id: str, deployment_id: str, container):
         """Stream container logs to Console"""
+        logs = iterate_in_thread(
+            lambda: container.logs(stream=True, follow=True),
+            name=f"logs-{app_id[:8]}"
+        )
         try:
-            for log_line in container.logs(stream=True, follow=True):
-                log_text = log_line.decode('utf-8').strip()
-                if log_text:
-                    await self.send_log(app_id, deployment_id, log_text)
+            async with aclosing(logs):
+                async for log_line in logs:
+                    log_text = log_line.decode('utf-8', errors='replace').strip()
+                    if log_text:
+                        await self.send_log(app_id, deployment_id, log_text)
         except Exception as e:
             logger.error(f"Error streaming logs: {e}")
     
+    async def stream_container_stats(self, app_id: str, container):
+        """Follow the container's stats stream, sending metrics every METRICS_INTERVAL seconds"""
+        last_emit = None
+        stats_stream = iterate_in_thread(
+            lambda: container.stats(stream=True, decode=True),
+            name=f"stats-{app_id[:8]}"
+        )
+        # aclosing stops the reader thread as soon as this loop exits
+        async with aclosing(stats_stream):
+            async for stats in stats_stream:
+                if not self.running:
+                    break
+                
+                # The first streamed sample has no previous system reading to take a CPU delta from
+                if 'system_cpu_usage' not in stats.get('precpu_stats', {}):
+                    continue
+                
+                now = time.monotonic()
+                if last_emit is not None and now - last_emit < METRICS_INTERVAL:
+                    continue
+                last_emit = now
+                
+                try:
+                    await self.send_container_metrics(app_id, stats)
+                except Exception as e:
+                    logger.error(f"Error collecting metrics for {app_id}: {e}")
+    
     async def handle_stop(self, data: dict):
         """Stop a running container"""
         app_id = data.get('app_id')
@@ -280,9 +410,10 @@ class Agent:
         if app_id in running_containers:
             try:
                 container = running_containers[app_id]
-                container.stop(timeout=10)
-                container.remove()
+                await asyncio.to_thread(container.stop, timeout=10)
+                await asyncio.to_thread(container.remove)
                 del running_containers[app_id]
+                container_started_at.pop(app_id, None)
                 logger.info(f"Stopped container for app {app_id}")
             except Exception as e:
                 logger.error(f"Failed to stop container: {e}")
@@ -294,48 +425,81 @@ class Agent:
         if app_id in running_containers:
             try:
                 container = running_containers[app_id]
-                container.restart(timeout=10)
+                await asyncio.to_thread(container.restart, timeout=10)
+                container_started_at[app_id] = time.monotonic()
                 logger.info(f"Restarted container for app {app_id}")
             except Exception as e:
                 logger.error(f"Failed to restart container: {e}")
     
-    async def metrics_loop(self):
-        """Periodically send metrics for running containers"""
-        while self.running:
-            try:
-                for app_id, container in running_containers.items():
-                    try:
-                        container.reload()
-                        stats = container.stats(stream=False)
-                        
-                        # Calculate CPU percentage
-                        cpu_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - \
-                                    stats['precpu_stats']['cpu_usage']['total_usage']
-                        system_delta = stats['cpu_stats']['system_cpu_usage'] - \
-                                      stats['precpu_stats']['system_cpu_usage']
-                        cpu_percent = (cpu_delta / system_delta) * 100.0 if system_delta > 0 else 0.0
-                        
-                        # Memory usage
-                        memory_usage = stats['memory_stats'].get('usage', 0) / (1024 * 1024)  # MB
-                        
-                        await self.send_message({
-                            "type": "metrics",
-                            "data": {
-                                "app_id": app_id,
-                                "cpu_percent": round(cpu_percent, 2),
-                                "memory_mb": round(memory_usage, 2),
-                                "uptime_seconds": 0,  # Calculate from container start time
-                                "request_count": 0  # Would need instrumentation
-                            }
-                        })
-                    except Exception as e:
-                        logger.error(f"Error collecting metrics for {app_id}: {e}")
-                
-                await asyncio.sleep(10)  # Send metrics every 10 seconds
-            
-            except Exception as e:
-                logger.error(f"Error in metrics loop: {e}")
-                await asyncio.sleep(10)
+    async def send_container_metrics(self, app_id: str, stats: dict):
+        """Send metrics computed from one stats sample to Console"""
+        # Calculate CPU percentage
+        cpu_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - \
+                    stats['precpu_stats']['cpu_usage']['total_usage']
+        system_delta = stats['cpu_stats'].get('system_cpu_usage', 0) - \
+                      stats['precpu_stats'].get('system_cpu_usage', 0)
+        cpu_percent = (cpu_delta / system_delta) * 100.0 if system_delta > 0 else 0.0
+        
+        # Memory usage
+        memory_usage = stats['memory_stats'].get('usage', 0) / (1024 * 1024)  # MB
+        
+        started_at = container_started_at.get(app_id)
+        uptime = int(time.monotonic() - started_at) if started_at else 0
+        
+        await self.send_message({
+            "type": "metrics",
+            "data": {
+                "app_id": app_id,
+                "cpu_percent": round(cpu_percent, 2),
+                "memory_mb": round(memory_usage, 2),
+                "uptime_seconds": uptime,
+                "request_count": 0  # Would need instrumentation
+            }
+        })
+
+async def iterate_in_thread(make_iterator, name: str):
+    """
+    Iterate a blocking docker-py stream from a daemon thread.
+    Used for follow-style streams that last as long as the container, so they
+    get their own thread instead of holding a slot in the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=STREAM_BUFFER_SIZE)
+    stopped = threading.Event()  # set once the consumer goes away
+    
+    def offer(item):
+        # Runs on the loop; a slow consumer loses the oldest items, never the end marker
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+    
+    def hand_over(item) -> bool:
+        try:
+            loop.call_soon_threadsafe(offer, item)
+            return True
+        except RuntimeError:
+            # Loop already closed (agent shut down) - nobody is left to consume
+            return False
+    
+    def pump():
+        try:
+            for item in make_iterator():
+                if stopped.is_set() or not hand_over(item):
+                    break
+        except Exception as e:
+            logger.error(f"Error in {name} stream: {e}")
+        finally:
+            if not stopped.is_set():
+                hand_over(None)
+    
+    threading.Thread(target=pump, name=name, daemon=True).start()
+    
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+    finally:
+        # Covers consumer errors, break and cancellation - the thread exits on its next item
+        stopped.set()
 
 async def main():
     global shutdown_flag
@@ -353,20 +517,25 @@ async def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
+    agent.start_deploy_workers()
+    
     try:
         await agent.connect_with_retry()
     except KeyboardInterrupt:
         logger.info("Agent interrupted by user")
     finally:
-        # Wait for current build to finish
-        if agent.current_build:
-            logger.info(f"Waiting for current build {agent.current_build} to complete...")
+        # Wait for in-flight builds to finish
+        if agent.current_builds:
+            logger.info(f"Waiting for current builds {sorted(agent.current_builds)} to complete...")
             timeout = 60  # Wait up to 60 seconds
             start = asyncio.get_event_loop().time()
-            while agent.current_build and (asyncio.get_event_loop().time() - start) < timeout:
+            while agent.current_builds and (asyncio.get_event_loop().time() - start) < timeout:
                 await asyncio.sleep(1)
         
         logger.info("Agent shutdown complete")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -1,32 +1,42 @@
 import os
+import hashlib
+from functools import lru_cache
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import base64
+
+# SIMD-accelerated base64 when available; same API and output as the stdlib
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 # Master key for encryption - in production, this should be from env or KMS
 MASTER_KEY = os.environ.get('MASTER_ENCRYPTION_KEY', 'dev-master-key-32-bytes-long!!').encode()
 
-# Derive a proper 256-bit key
+# Derive a proper 256-bit key (cached - MASTER_KEY and salt are process-wide constants).
+# hashlib runs PBKDF2 inside OpenSSL, using SHA extensions where the CPU has them,
+# which matters again if per-secret salts are adopted and the cache stops applying.
+@lru_cache(maxsize=1)
 def get_encryption_key():
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=b'dead-simple-infra-salt',  # In production, use random salt per secret
-        iterations=100000,
+    return hashlib.pbkdf2_hmac(
+        'sha256',
+        MASTER_KEY,
+        b'dead-simple-infra-salt',  # In production, use random salt per secret
+        100000,
+        32
     )
-    return kdf.derive(MASTER_KEY)
+
+# Shared cipher instance, keyed once at import. AESGCM already runs on OpenSSL's
+# AES-NI/PCLMULQDQ path; keeping it preserves the stored nonce + ciphertext + tag layout.
+_AESGCM = AESGCM(get_encryption_key())
 
 def encrypt_secret(plaintext: str) -> str:
     """
     Encrypt a secret using AES-256-GCM.
     Returns base64-encoded nonce + ciphertext.
     """
-    key = get_encryption_key()
-    aesgcm = AESGCM(key)
     nonce = os.urandom(12)  # 96-bit nonce for GCM
     
-    ciphertext = aesgcm.encrypt(nonce, plaintext.encode(), None)
+    ciphertext = _AESGCM.encrypt(nonce, plaintext.encode(), None)
     
     # Combine nonce + ciphertext and encode as base64
     encrypted_data = nonce + ciphertext
@@ -36,16 +46,13 @@ def decrypt_secret(encrypted_data: str) -> str:
     """
     Decrypt a secret using AES-256-GCM.
     """
-    key = get_encryption_key()
-    aesgcm = AESGCM(key)
-    
     # Decode from base64
-    encrypted_bytes = base64.b64decode(encrypted_data.encode('utf-8'))
+    encrypted_bytes = base64.b64decode(encrypted_data)
     
     # Extract nonce and ciphertext
     nonce = encrypted_bytes[:12]
     ciphertext = encrypted_bytes[12:]
     
     # Decrypt
-    plaintext = aesgcm.decrypt(nonce, ciphertext, None)
+    plaintext = _AESGCM.decrypt(nonce, ciphertext, None)
     return plaintext.decode('utf-8')
@@ -1,8 +1,9 @@
-from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Request
+from fastapi import FastAPI, APIRouter, HTTPException, WebSocket, WebSocketDisconnect, Request, Depends
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 import os
 import logging
 from pathlib import Path
@@ -11,14 +12,25 @@ from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, timezone
 import asyncio
-import json
+import orjson
+from collections import deque
+from itertools import islice
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so native BSON dates read back as UTC-aware datetimes; the pool is
+# sized up front and warmed in startup_event so early requests skip the handshake
+client = AsyncIOMotorClient(
+    mongo_url,
+    tz_aware=True,
+    maxPoolSize=100,
+    minPoolSize=10,
+    uuidRepresentation='standard',
+    compressors='zstd,zlib'
+)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
@@ -29,7 +41,66 @@ api_router = APIRouter(prefix="/api")
 
 # Store active WebSocket connections
 active_agents: Dict[str, WebSocket] = {}
-log_subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+# Deploy dispatch: round-robin over connected agents, sticky per app
+_agent_ring: List[str] = []
+_next_agent = 0
+app_agents: Dict[str, str] = {}  # app_id -> agent_id that deployed it
+
+def pick_agent(app_id: str) -> Optional[str]:
+    """Return the agent that owns app_id, assigning the next one in the ring if needed"""
+    global _next_agent
+    agent_id = app_agents.get(app_id)
+    if agent_id in active_agents:
+        return agent_id
+    if not _agent_ring:
+        return None
+    
+    agent_id = _agent_ring[_next_agent % len(_agent_ring)]
+    _next_agent += 1
+    app_agents[app_id] = agent_id
+    return agent_id
+
+# Log fanout: one ring buffer per app shared by all SSE subscribers
+LOG_BUFFER_SIZE = 1024
+
+class LogTopic:
+    """Broadcast topic - subscribers keep their own read position, oldest lines drop on overflow"""
+    __slots__ = ('buffer', 'event', 'seq', 'subscribers')
+    
+    def __init__(self):
+        self.buffer = deque(maxlen=LOG_BUFFER_SIZE)
+        self.event = asyncio.Event()
+        self.seq = 0  # total lines published
+        self.subscribers = 0
+    
+    def publish(self, data: dict):
+        # No awaits: a slow subscriber can never hold up the agent websocket
+        self.buffer.append(data)
+        self.seq += 1
+        self.event.set()
+        self.event.clear()  # current waiters are already woken
+    
+    async def listen(self):
+        last_seq = self.seq
+        while True:
+            if self.seq == last_seq:
+                await self.event.wait()
+            
+            # Lines published since last read, capped at what the ring still holds
+            pending = min(self.seq - last_seq, len(self.buffer))
+            last_seq = self.seq
+            for log_data in list(islice(self.buffer, len(self.buffer) - pending, None)):
+                yield log_data
+
+log_topics: Dict[str, LogTopic] = {}
+
+# Buffered agent writes, flushed in batches by _flush_loop
+WRITE_FLUSH_INTERVAL = 0.1  # seconds
+METRICS_BATCH_SIZE = 500
+_metrics_queue: asyncio.Queue = asyncio.Queue()
+_app_updates: Dict[str, Dict[str, Any]] = {}  # latest $set fields per app_id
+_flush_task: Optional[asyncio.Task] = None
 
 # Define Models
 class App(BaseModel):
@@ -114,44 +185,33 @@ async def healthz():
     """Health check endpoint - always returns 200 if service is up"""
     return {"status": "ok"}
 
+def get_active_agents() -> Dict[str, WebSocket]:
+    """Connected agents, as a dependency so it can be overridden"""
+    return active_agents
+
 @api_router.get("/readyz")
-async def readyz():
+async def readyz(agents: Dict[str, WebSocket] = Depends(get_active_agents)):
     """Readiness check - fails if no agents connected"""
-    if len(active_agents) == 0:
+    if len(agents) == 0:
         raise HTTPException(status_code=503, detail="No agents connected")
-    return {"status": "ok", "agents_count": len(active_agents)}
+    return {"status": "ok", "agents_count": len(agents)}
 
 # Apps Management
 @api_router.post("/v1/apps", response_model=App)
 async def create_app(input: AppCreate):
     app_obj = App(**input.model_dump())
-    doc = app_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    
-    await db.apps.insert_one(doc)
+    await db.apps.insert_one(app_obj.model_dump())
     return app_obj
 
 @api_router.get("/v1/apps", response_model=List[App])
 async def list_apps():
-    apps = await db.apps.find({}, {"_id": 0}).to_list(1000)
-    for app in apps:
-        if isinstance(app.get('created_at'), str):
-            app['created_at'] = datetime.fromisoformat(app['created_at'])
-        if isinstance(app.get('updated_at'), str):
-            app['updated_at'] = datetime.fromisoformat(app['updated_at'])
-    return apps
+    return await db.apps.find({}, {"_id": 0}).to_list(1000)
 
 @api_router.get("/v1/apps/{app_id}", response_model=App)
 async def get_app(app_id: str):
     app = await db.apps.find_one({"id": app_id}, {"_id": 0})
     if not app:
         raise HTTPException(status_code=404, detail="App not found")
-    
-    if isinstance(app.get('created_at'), str):
-        app['created_at'] = datetime.fromisoformat(app['created_at'])
-    if isinstance(app.get('updated_at'), str):
-        app['updated_at'] = datetime.fromisoformat(app['updated_at'])
     return app
 
 @api_router.delete("/v1/apps/{app_id}")
@@ -163,6 +223,7 @@ async def delete_app(app_id: str):
     # Also delete related secrets and deployments
     await db.secrets.delete_many({"app_id": app_id})
     await db.deployments.delete_many({"app_id": app_id})
+    app_agents.pop(app_id, None)
     
     return {"message": "App deleted successfully"}
 
@@ -176,27 +237,28 @@ async def trigger_deployment(app_id: str):
     
     # Create deployment record
     deployment = Deployment(app_id=app_id, status="pending")
-    doc = deployment.model_dump()
-    doc['started_at'] = doc['started_at'].isoformat()
-    await db.deployments.insert_one(doc)
+    await db.deployments.insert_one(deployment.model_dump())
     
-    # Update app status
+    # Update app status - drop any buffered agent update from the previous deploy
+    # first so it can't land after this write and overwrite it
+    _app_updates.pop(app_id, None)
     await db.apps.update_one(
         {"id": app_id},
-        {"$set": {"status": "building", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"status": "building", "updated_at": datetime.now(timezone.utc)}}
     )
     
     # Send deploy command to agent via WebSocket
-    if active_agents:
-        agent_ws = list(active_agents.values())[0]
+    agent_id = pick_agent(app_id)
+    if agent_id:
+        agent_ws = active_agents[agent_id]
         try:
-            await agent_ws.send_json({
+            await agent_ws.send_bytes(orjson.dumps({
                 "type": "deploy",
                 "deployment_id": deployment.id,
                 "app_id": app_id,
                 "repo_url": app.get('repo_url'),
                 "app_name": app.get('name')
-            })
+            }))
         except Exception as e:
             logging.error(f"Failed to send deploy command: {e}")
     
@@ -230,18 +292,10 @@ async def get_app_status(app_id: str):
 
 @api_router.get("/v1/deployments/{app_id}", response_model=List[Deployment])
 async def get_deployments(app_id: str):
-    deployments = await db.deployments.find(
+    return await db.deployments.find(
         {"app_id": app_id},
         {"_id": 0}
     ).sort("started_at", -1).to_list(100)
-    
-    for dep in deployments:
-        if isinstance(dep.get('started_at'), str):
-            dep['started_at'] = datetime.fromisoformat(dep['started_at'])
-        if dep.get('completed_at') and isinstance(dep['completed_at'], str):
-            dep['completed_at'] = datetime.fromisoformat(dep['completed_at'])
-    
-    return deployments
 
 # Secrets Management
 @api_router.post("/v1/apps/{app_id}/secrets")
@@ -268,15 +322,11 @@ async def add_secret(app_id: str, secret: SecretCreate):
         version=1
     )
     
-    doc = secret_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
-    
-    await db.secrets.insert_one(doc)
+    await db.secrets.insert_one(secret_obj.model_dump())
     
     # Audit log
     await db.secrets_audit.insert_one({
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": datetime.now(timezone.utc),
         "user": "mvp-single-user",
         "action": "created",
         "secret_name": secret.key,
@@ -307,13 +357,13 @@ async def rotate_secret(app_id: str, rotation: SecretRotate):
         {"$set": {
             "encrypted_value": encrypted_value,
             "version": new_version,
-            "updated_at": datetime.now(timezone.utc).isoformat()
+            "updated_at": datetime.now(timezone.utc)
         }}
     )
     
     # Audit log
     await db.secrets_audit.insert_one({
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": datetime.now(timezone.utc),
         "user": "mvp-single-user",
         "action": "rotated",
         "secret_name": rotation.key,
@@ -323,14 +373,15 @@ async def rotate_secret(app_id: str, rotation: SecretRotate):
     
     # Notify agent of secret rotation via WebSocket
     if active_agents:
+        payload = orjson.dumps({
+            "type": "secret_rotate",
+            "app_id": app_id,
+            "secret_key": rotation.key,
+            "version": new_version
+        })
         for agent_ws in active_agents.values():
             try:
-                await agent_ws.send_json({
-                    "type": "secret_rotate",
-                    "app_id": app_id,
-                    "secret_key": rotation.key,
-                    "version": new_version
-                })
+                await agent_ws.send_bytes(payload)
             except Exception as e:
                 logger.error(f"Failed to notify agent of secret rotation: {e}")
     
@@ -342,30 +393,15 @@ async def rotate_secret(app_id: str, rotation: SecretRotate):
 
 @api_router.get("/v1/apps/{app_id}/secrets")
 async def get_secrets(app_id: str):
-    secrets = await db.secrets.find({"app_id": app_id}, {"_id": 0, "encrypted_value": 0}).to_list(100)
-    
-    # Convert datetime strings
-    for secret in secrets:
-        if isinstance(secret.get('created_at'), str):
-            secret['created_at'] = datetime.fromisoformat(secret['created_at'])
-        if isinstance(secret.get('updated_at'), str):
-            secret['updated_at'] = datetime.fromisoformat(secret['updated_at'])
-    
-    return secrets
+    return await db.secrets.find({"app_id": app_id}, {"_id": 0, "encrypted_value": 0}).to_list(100)
 
 @api_router.get("/v1/apps/{app_id}/secrets/{secret_key}/history")
 async def get_secret_history(app_id: str, secret_key: str):
     """Get audit history for a secret"""
-    history = await db.secrets_audit.find(
+    return await db.secrets_audit.find(
         {"app_id": app_id, "secret_name": secret_key},
         {"_id": 0}
     ).sort("timestamp", -1).to_list(50)
-    
-    for entry in history:
-        if isinstance(entry.get('timestamp'), str):
-            entry['timestamp'] = datetime.fromisoformat(entry['timestamp'])
-    
-    return history
 
 @api_router.delete("/v1/apps/{app_id}/secrets/{secret_id}")
 async def delete_secret(app_id: str, secret_id: str):
@@ -378,22 +414,113 @@ async def delete_secret(app_id: str, secret_id: str):
 @api_router.post("/v1/agents/register", response_model=Agent)
 async def register_agent(input: AgentRegister):
     agent_obj = Agent(**input.model_dump(), status="online")
-    doc = agent_obj.model_dump()
-    doc['registered_at'] = doc['registered_at'].isoformat()
-    doc['last_seen'] = doc['last_seen'].isoformat()
-    
-    await db.agents.insert_one(doc)
+    await db.agents.insert_one(agent_obj.model_dump())
     return agent_obj
 
 @api_router.get("/v1/agents", response_model=List[Agent])
 async def list_agents():
-    agents = await db.agents.find({}, {"_id": 0}).to_list(100)
-    for agent in agents:
-        if isinstance(agent.get('registered_at'), str):
-            agent['registered_at'] = datetime.fromisoformat(agent['registered_at'])
-        if isinstance(agent.get('last_seen'), str):
-            agent['last_seen'] = datetime.fromisoformat(agent['last_seen'])
-    return agents
+    return await db.agents.find({}, {"_id": 0}).to_list(100)
+
+# Batched writes for agent traffic
+def queue_app_update(app_id: str, fields: Dict[str, Any]):
+    """Coalesce app field updates; later values for the same app win"""
+    _app_updates.setdefault(app_id, {}).update(fields)
+
+async def flush_writes():
+    """Write out buffered metrics and app updates; anything not written is re-queued"""
+    while not _metrics_queue.empty():
+        batch = []
+        while not _metrics_queue.empty() and len(batch) < METRICS_BATCH_SIZE:
+            batch.append(_metrics_queue.get_nowait())
+        try:
+            await db.metrics.insert_many(batch, ordered=False)
+        except Exception:
+            # insert_many already set each _id, so a retry can't insert a metric twice
+            for metrics_data in batch:
+                _metrics_queue.put_nowait(metrics_data)
+            raise
+    
+    if _app_updates:
+        updates = list(_app_updates.items())
+        _app_updates.clear()
+        try:
+            await db.apps.bulk_write(
+                [UpdateOne({"id": app_id}, {"$set": fields}) for app_id, fields in updates],
+                ordered=False
+            )
+        except Exception:
+            # Put the fields back under anything queued while the write was in flight
+            for app_id, fields in updates:
+                _app_updates[app_id] = {**fields, **_app_updates.get(app_id, {})}
+            raise
+
+async def _flush_loop():
+    while True:
+        await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+        try:
+            await flush_writes()
+        except Exception as e:
+            logger.error(f"Failed to flush buffered writes: {e}")
+
+async def handle_agent_message(data: dict):
+    """Apply a single message received from an agent"""
+    msg_type = data.get("type")
+    
+    if msg_type == "log":
+        # Broadcast log to subscribers
+        topic = log_topics.get(data.get("app_id"))
+        if topic:
+            topic.publish(data)
+    
+    elif msg_type == "status_update":
+        # Update app status
+        app_id = data.get("app_id")
+        status = data.get("status")
+        queue_app_update(app_id, {"status": status, "updated_at": datetime.now(timezone.utc)})
+        
+        # Update deployment status
+        deployment_id = data.get("deployment_id")
+        if deployment_id:
+            await db.deployments.update_one(
+                {"id": deployment_id},
+                {"$set": {"status": status}}
+            )
+    
+    elif msg_type == "metrics":
+        # Store metrics
+        metrics_data = data.get("data", {})
+        # Native BSON date - no isoformat round-trip per sample
+        metrics_data['timestamp'] = datetime.now(timezone.utc)
+        _metrics_queue.put_nowait(metrics_data)
+    
+    elif msg_type == "deployment_complete":
+        app_id = data.get("app_id")
+        deployment_id = data.get("deployment_id")
+        port = data.get("port")
+        url = data.get("url")
+        now = datetime.now(timezone.utc)
+        
+        queue_app_update(app_id, {
+            "status": "running",
+            "port": port,
+            "url": url,
+            "updated_at": now
+        })
+        
+        await db.deployments.update_one(
+            {"id": deployment_id},
+            {"$set": {
+                "status": "running",
+                "completed_at": now
+            }}
+        )
+
+async def receive_agent_message(websocket: WebSocket) -> dict:
+    """Read one agent frame (binary or text) and parse it with orjson"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return orjson.loads(message.get("bytes") or message["text"])
 
 # WebSocket for Agent Communication
 @app.websocket("/api/v1/agents/stream")
@@ -401,67 +528,20 @@ async def agent_websocket(websocket: WebSocket):
     await websocket.accept()
     agent_id = str(uuid.uuid4())
     active_agents[agent_id] = websocket
+    _agent_ring.append(agent_id)
     
     logging.info(f"Agent {agent_id} connected")
     
     try:
         while True:
-            data = await websocket.receive_json()
-            msg_type = data.get("type")
+            data = await receive_agent_message(websocket)
             
-            if msg_type == "log":
-                # Broadcast log to subscribers
-                app_id = data.get("app_id")
-                if app_id in log_subscribers:
-                    for queue in log_subscribers[app_id]:
-                        await queue.put(data)
-            
-            elif msg_type == "status_update":
-                # Update app status
-                app_id = data.get("app_id")
-                status = data.get("status")
-                await db.apps.update_one(
-                    {"id": app_id},
-                    {"$set": {"status": status, "updated_at": datetime.now(timezone.utc).isoformat()}}
-                )
-                
-                # Update deployment status
-                deployment_id = data.get("deployment_id")
-                if deployment_id:
-                    await db.deployments.update_one(
-                        {"id": deployment_id},
-                        {"$set": {"status": status}}
-                    )
-            
-            elif msg_type == "metrics":
-                # Store metrics
-                metrics_data = data.get("data", {})
-                metrics_data['timestamp'] = datetime.now(timezone.utc).isoformat()
-                await db.metrics.insert_one(metrics_data)
-            
-            elif msg_type == "deployment_complete":
-                app_id = data.get("app_id")
-                deployment_id = data.get("deployment_id")
-                port = data.get("port")
-                url = data.get("url")
-                
-                await db.apps.update_one(
-                    {"id": app_id},
-                    {"$set": {
-                        "status": "running",
-                        "port": port,
-                        "url": url,
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                
-                await db.deployments.update_one(
-                    {"id": deployment_id},
-                    {"$set": {
-                        "status": "running",
-                        "completed_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
+            # Agents coalesce queued messages into batch frames
+            if data.get("type") == "batch":
+                for msg in data.get("msgs", []):
+                    await handle_agent_message(msg)
+            else:
+                await handle_agent_message(data)
     
     except WebSocketDisconnect:
         logging.info(f"Agent {agent_id} disconnected")
@@ -470,24 +550,23 @@ async def agent_websocket(websocket: WebSocket):
     finally:
         if agent_id in active_agents:
             del active_agents[agent_id]
+        if agent_id in _agent_ring:
+            _agent_ring.remove(agent_id)
 
 # SSE for Log Streaming
 @api_router.get("/v1/apps/{app_id}/logs/stream")
 async def stream_logs(app_id: str):
     async def event_generator():
-        queue = asyncio.Queue()
-        
-        if app_id not in log_subscribers:
-            log_subscribers[app_id] = []
-        log_subscribers[app_id].append(queue)
+        topic = log_topics.setdefault(app_id, LogTopic())
+        topic.subscribers += 1
         
         try:
-            while True:
-                log_data = await queue.get()
-                yield f"data: {json.dumps(log_data)}\n\n"
-        except asyncio.CancelledError:
-            if app_id in log_subscribers and queue in log_subscribers[app_id]:
-                log_subscribers[app_id].remove(queue)
+            async for log_data in topic.listen():
+                yield b"data: " + orjson.dumps(log_data) + b"\n\n"
+        finally:
+            topic.subscribers -= 1
+            if topic.subscribers == 0 and log_topics.get(app_id) is topic:
+                del log_topics[app_id]
     
     return StreamingResponse(
         event_generator(),
@@ -501,16 +580,10 @@ async def stream_logs(app_id: str):
 # Metrics endpoint
 @api_router.get("/v1/apps/{app_id}/metrics")
 async def get_metrics(app_id: str, limit: int = 50):
-    metrics = await db.metrics.find(
+    return await db.metrics.find(
         {"app_id": app_id},
         {"_id": 0}
     ).sort("timestamp", -1).limit(limit).to_list(limit)
-    
-    for metric in metrics:
-        if isinstance(metric.get('timestamp'), str):
-            metric['timestamp'] = datetime.fromisoformat(metric['timestamp'])
-    
-    return metrics
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -533,9 +606,26 @@ logger = logging.getLogger(__name__)
 # Graceful shutdown flag
 shutdown_flag = False
 
+async def ensure_indexes():
+    """Create the indexes backing the per-app lookups and latest-first sorts"""
+    await db.apps.create_index([("id", 1)], unique=True)
+    await db.deployments.create_index([("app_id", 1), ("started_at", -1)])
+    await db.metrics.create_index([("app_id", 1), ("timestamp", -1)])
+    await db.secrets.create_index([("app_id", 1), ("key", 1)])
+    await db.secrets_audit.create_index([("app_id", 1), ("secret_name", 1), ("timestamp", -1)])
+
 @app.on_event("startup")
 async def startup_event():
+    global _flush_task
     logger.info("Console API starting up")
+    
+    try:
+        await client.admin.command('ping')
+        await ensure_indexes()
+    except Exception as e:
+        logger.error(f"Failed to prepare MongoDB: {e}")
+    
+    _flush_task = asyncio.create_task(_flush_loop())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
@@ -551,6 +641,14 @@ async def shutdown_db_client():
         except Exception as e:
             logger.error(f"Error closing agent connection: {e}")
     
+    # Stop the flush loop and write out anything still buffered
+    if _flush_task:
+        _flush_task.cancel()
+    try:
+        await flush_writes()
+    except Exception as e:
+        logger.error(f"Failed to flush buffered writes: {e}")
+    
     # Close MongoDB client
     client.close()
     logger.info("Console API shutdown complete")
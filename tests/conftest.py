@@ -0,0 +1,81 @@
+"""
+Shared fixtures for the backend tests.
+"""
+
+import pytest
+import httpx
+from unittest.mock import patch, MagicMock, AsyncMock, DEFAULT
+import sys
+import os
+from websockets.asyncio.client import ClientConnection
+
+# Add backend to path once for every test module
+backend_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'backend'))
+if backend_path not in sys.path:
+    sys.path.insert(0, backend_path)
+
+# Mock the MongoDB client at its source so server.py's module-level client is the mock;
+# startup awaits ping and create_index, so those need to be awaitable
+_MONGO_MOCK = MagicMock()
+_MONGO_MOCK.admin.command = AsyncMock()
+_MONGO_MOCK.__getitem__.return_value = AsyncMock()
+
+with patch('motor.motor_asyncio.AsyncIOMotorClient', MagicMock(return_value=_MONGO_MOCK)):
+    import server
+
+# agent.py connects to the Docker daemon at import time
+with patch('docker.from_env', MagicMock()):
+    import agent
+
+
+def _WS_FACTORY(messages=()):
+    """
+    Pre-wired agent websocket: usable as `async with websockets.connect(...) as ws`,
+    yields `messages` when iterated. spec'd so attribute lookups don't build new mocks.
+    """
+    websocket = AsyncMock(spec=ClientConnection)
+    websocket.__aenter__.return_value = websocket
+    websocket.__aiter__.return_value = list(messages)
+    return websocket
+
+
+@pytest.fixture(scope="session")
+def server_module():
+    """The console module, imported once against the mocked MongoDB client"""
+    return server
+
+
+@pytest.fixture(scope="session")
+def agent_module():
+    """The agent module, imported once against a mocked Docker client"""
+    return agent
+
+
+@pytest.fixture
+def agent_env(agent_module):
+    """Patch the agent's websockets, logger and Docker client; yields the mocks by name"""
+    with patch.multiple(agent_module, websockets=DEFAULT, logger=DEFAULT, docker_client=DEFAULT) as mocks:
+        yield mocks
+
+
+@pytest.fixture(scope="session")
+def make_websocket():
+    """Factory for pre-wired agent websocket mocks"""
+    return _WS_FACTORY
+
+
+@pytest.fixture(scope="session")
+async def client(server_module):
+    """One async client for the whole session, calling the app in-process through ASGITransport"""
+    transport = httpx.ASGITransport(app=server_module.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as async_client:
+        yield async_client
+
+
+@pytest.fixture
+def active_agents(server_module):
+    """Agents seen by dependency-injected endpoints; starts empty, override removed after the test"""
+    agents = {}
+    server_module.app.dependency_overrides[server_module.get_active_agents] = lambda: agents
+    yield agents
+    server_module.app.dependency_overrides.pop(server_module.get_active_agents, None)
@@ -0,0 +1,230 @@
+"""
+Tests for the console's agent traffic handling:
+- Buffered metrics and app status writes
+- Agent batch frames
+- Log fanout to SSE subscribers
+- Deploy dispatch across agents
+"""
+
+import pytest
+import asyncio
+from unittest.mock import patch, MagicMock, AsyncMock
+import sys
+from pymongo import UpdateOne
+
+
+@pytest.fixture
+def buffered_writes(server_module):
+    """Mocked db for flush_writes; the write buffers start and end empty"""
+    db = MagicMock()
+    db.apps.bulk_write = AsyncMock()
+    db.metrics.insert_many = AsyncMock()
+    server_module._app_updates.clear()
+    with patch.object(server_module, 'db', db):
+        yield db
+    server_module._app_updates.clear()
+    while not server_module._metrics_queue.empty():
+        server_module._metrics_queue.get_nowait()
+
+
+async def test_app_updates_coalesce_later_fields_win(server_module, buffered_writes):
+    """Test that queued updates for one app merge into a single $set, newest values winning"""
+    server_module.queue_app_update("app-1", {"status": "building", "container_id": "abc"})
+    server_module.queue_app_update("app-1", {"status": "running"})
+    server_module.queue_app_update("app-2", {"status": "failed"})
+
+    await server_module.flush_writes()
+
+    buffered_writes.apps.bulk_write.assert_awaited_once_with([
+        UpdateOne({"id": "app-1"}, {"$set": {"status": "running", "container_id": "abc"}}),
+        UpdateOne({"id": "app-2"}, {"$set": {"status": "failed"}}),
+    ], ordered=False)
+    assert server_module._app_updates == {}
+
+
+async def test_failed_app_update_flush_is_requeued(server_module, buffered_writes):
+    """Test that a failed bulk write puts its fields back under updates queued meanwhile"""
+    async def fail_after_new_update(requests, ordered):
+        server_module.queue_app_update("app-1", {"status": "running"})
+        raise ConnectionError("MongoDB unavailable")
+
+    buffered_writes.apps.bulk_write.side_effect = fail_after_new_update
+    server_module.queue_app_update("app-1", {"status": "building", "container_id": "abc"})
+
+    with pytest.raises(ConnectionError):
+        await server_module.flush_writes()
+
+    assert server_module._app_updates == {"app-1": {"status": "running", "container_id": "abc"}}
+
+
+async def test_failed_metrics_flush_is_requeued(server_module, buffered_writes):
+    """Test that metrics from a failed insert go back on the queue"""
+    buffered_writes.metrics.insert_many.side_effect = ConnectionError("MongoDB unavailable")
+    metrics = [{"app_id": "app-1", "cpu_percent": float(i)} for i in range(3)]
+    for metrics_data in metrics:
+        server_module._metrics_queue.put_nowait(metrics_data)
+
+    with pytest.raises(ConnectionError):
+        await server_module.flush_writes()
+
+    requeued = []
+    while not server_module._metrics_queue.empty():
+        requeued.append(server_module._metrics_queue.get_nowait())
+    assert requeued == metrics
+
+
+async def test_agent_batch_frames_unwrap_to_sent_messages(agent_module, server_module, make_websocket):
+    """Test that frames from the agent's sender_loop reach the console as the original messages"""
+    messages = [{"type": "log", "app_id": "app-1", "log": f"line {i}"} for i in range(3)]
+    agent = agent_module.Agent()
+    agent.outbox = asyncio.Queue(maxsize=agent_module.OUTBOX_SIZE)
+    agent.websocket = make_websocket()
+    
+    # Queued together they go out as one batch frame; the last one alone as a plain frame
+    for msg in messages[:2]:
+        await agent.send_message(msg)
+    sender = asyncio.create_task(agent.sender_loop())
+    try:
+        async with asyncio.timeout(0.1):
+            while agent.websocket.send.await_count < 1:
+                await asyncio.sleep(0)
+            await agent.send_message(messages[2])
+            while agent.websocket.send.await_count < 2:
+                await asyncio.sleep(0)
+    finally:
+        sender.cancel()
+    frames = [call.args[0] for call in agent.websocket.send.await_args_list]
+    
+    console_ws = MagicMock()
+    console_ws.accept = AsyncMock()
+    console_ws.receive = AsyncMock(side_effect=[
+        {"type": "websocket.receive", "bytes": frame} for frame in frames
+    ] + [{"type": "websocket.disconnect", "code": 1000}])
+    with patch.object(server_module, 'handle_agent_message', new=AsyncMock()) as handle:
+        await server_module.agent_websocket(console_ws)
+    
+    assert len(frames) == 2
+    assert [call.args[0] for call in handle.await_args_list] == messages
+
+
+async def _next_line(listener):
+    """Wait for the listener's next line, failing instead of hanging if none arrives"""
+    async with asyncio.timeout(0.1):
+        return await anext(listener)
+
+
+async def test_log_topic_new_subscriber_sees_no_backlog(server_module):
+    """Test that a subscriber only receives lines published after it started listening"""
+    topic = server_module.LogTopic()
+    topic.publish({"log": "before"})
+    listener = topic.listen()
+    
+    waiter = asyncio.create_task(_next_line(listener))
+    await asyncio.sleep(0)  # subscriber is now waiting on the topic
+    topic.publish({"log": "after"})
+    
+    assert await waiter == {"log": "after"}
+    await listener.aclose()
+
+
+async def test_log_topic_keeps_lines_published_during_yield(server_module):
+    """Test that lines published while a subscriber is busy with a yielded line are still delivered"""
+    topic = server_module.LogTopic()
+    listener = topic.listen()
+    
+    waiter = asyncio.create_task(_next_line(listener))
+    await asyncio.sleep(0)
+    topic.publish({"log": "line 1"})
+    topic.publish({"log": "line 2"})
+    assert await waiter == {"log": "line 1"}
+    
+    # Subscriber is suspended inside the yield of line 1
+    topic.publish({"log": "line 3"})
+    assert [await _next_line(listener) for _ in range(2)] == [{"log": "line 2"}, {"log": "line 3"}]
+    await listener.aclose()
+
+
+async def test_log_topic_overflow_drops_oldest_lines(server_module):
+    """Test that a subscriber falling more than LOG_BUFFER_SIZE behind gets only the newest lines"""
+    with patch.object(server_module, 'LOG_BUFFER_SIZE', 3):
+        topic = server_module.LogTopic()
+    listener = topic.listen()
+    
+    waiter = asyncio.create_task(_next_line(listener))
+    await asyncio.sleep(0)
+    for i in range(5):
+        topic.publish({"log": f"line {i}"})
+    
+    received = [await waiter] + [await _next_line(listener) for _ in range(2)]
+    assert received == [{"log": "line 2"}, {"log": "line 3"}, {"log": "line 4"}]
+    await listener.aclose()
+
+
+async def test_log_topic_removed_after_last_subscriber(server_module):
+    """Test that stream_logs shares one topic per app and drops it when the last subscriber leaves"""
+    app_id = "app-log-topic"
+    streams = [(await server_module.stream_logs(app_id)).body_iterator for _ in range(2)]
+    
+    waiters = [asyncio.create_task(_next_line(stream)) for stream in streams]
+    await asyncio.sleep(0)
+    topic = server_module.log_topics[app_id]
+    assert topic.subscribers == 2
+    topic.publish({"log": "hello"})
+    assert await asyncio.gather(*waiters) == [b'data: {"log":"hello"}\n\n'] * 2
+    
+    await streams[0].aclose()
+    assert server_module.log_topics[app_id] is topic
+    assert topic.subscribers == 1
+    
+    await streams[1].aclose()
+    assert app_id not in server_module.log_topics
+
+
+@pytest.fixture
+def agent_ring(server_module):
+    """Two connected agents in the dispatch ring, with no app assignments yet"""
+    agents = {"agent-1": MagicMock(), "agent-2": MagicMock()}
+    with patch.multiple(server_module, active_agents=agents, _agent_ring=list(agents),
+                        app_agents={}, _next_agent=0):
+        yield agents
+
+
+def test_pick_agent_round_robin(server_module, agent_ring):
+    """Test that new apps are spread over connected agents in turn"""
+    picked = [server_module.pick_agent(f"app-{i}") for i in range(4)]
+    
+    assert picked == ["agent-1", "agent-2", "agent-1", "agent-2"]
+
+
+def test_pick_agent_is_sticky_per_app(server_module, agent_ring):
+    """Test that redeploys of an app go back to the agent already running it"""
+    first = server_module.pick_agent("app-1")
+    server_module.pick_agent("app-2")
+    
+    assert server_module.pick_agent("app-1") == first
+    assert server_module.app_agents == {"app-1": "agent-1", "app-2": "agent-2"}
+
+
+def test_pick_agent_reassigns_after_owner_disconnects(server_module, agent_ring):
+    """Test that an app whose agent went away is assigned to a connected one"""
+    assert server_module.pick_agent("app-1") == "agent-1"
+    
+    # agent_websocket's cleanup on disconnect
+    del server_module.active_agents["agent-1"]
+    server_module._agent_ring.remove("agent-1")
+    
+    assert server_module.pick_agent("app-1") == "agent-2"
+    assert server_module.app_agents["app-1"] == "agent-2"
+
+
+def test_pick_agent_without_agents(server_module, agent_ring):
+    """Test that no agent is picked when none are connected"""
+    agent_ring.clear()
+    server_module._agent_ring.clear()
+    
+    assert server_module.pick_agent("app-1") is None
+
+
+if __name__ == "__main__":
+    # Run tests (fixtures need pytest)
+    sys.exit(pytest.main([__file__, "-v"]))